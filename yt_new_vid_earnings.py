@@ -10,31 +10,34 @@ import sys
 import argparse
 import logging
 import re
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import calendar
 from typing import Dict, List, Tuple, Any, Optional
-import json
+import math
 import time
+import random
+import socket
+import threading
+from functools import lru_cache, wraps
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
-import pandas as pd
-import numpy as np
 from dotenv import load_dotenv
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.auth.exceptions import RefreshError
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("youtube_analytics.log"),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+# orjson is optional; it parses the token file faster than the standard library
+try:
+    import orjson
+except ImportError:
+    import json as orjson
+
 logger = logging.getLogger(__name__)
 
 # Define scopes for YouTube Data API, YouTube Analytics API, and Google Sheets API
@@ -46,7 +49,39 @@ SCOPES = [
 
 # Constants
 TOKEN_FILE = 'token.json'
-API_QUOTA_DELAY = 1  # seconds between API calls to avoid quota issues
+TOKEN_PATH = Path(TOKEN_FILE)
+YOUTUBE_REQUESTS_PER_MINUTE = 60  # burst budget for YouTube Data API calls
+SHEETS_REQUESTS_PER_MINUTE = 60  # Sheets API per-user quota
+API_NUM_RETRIES = 5  # retries for rate-limited (429) and transient (5xx) API responses
+MAX_RETRY_DELAY = 60  # seconds; cap for Retry-After and exponential backoff waits
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+# Month names indexed by month number (index 0 is empty)
+_MONTH_NAMES = tuple(calendar.month_name)
+
+# Precompiled validation patterns
+_MONTH_RE = re.compile(r'^\d{2}/\d{4}$')
+_SHEET_URL_RE = re.compile(r'^https://docs\.google\.com/spreadsheets/d/([a-zA-Z0-9-_]+)')
+
+
+def setup_logging(debug=False):
+    """Log to a file, and also to the console when running interactively."""
+    # The log file isn't opened until the first record is written
+    handlers = [logging.FileHandler("youtube_analytics.log", delay=True)]
+    if sys.stdout.isatty():
+        handlers.append(logging.StreamHandler(sys.stdout))
+    
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=handlers
+    )
+    
+    # Only this script's logger goes to DEBUG; third-party loggers (e.g. the OAuth
+    # token exchange) would otherwise log secrets at that level
+    if debug:
+        logger.setLevel(logging.DEBUG)
 
 
 def parse_arguments():
@@ -65,11 +100,11 @@ def parse_arguments():
     args = parser.parse_args()
     
     # Validate month format
-    if not re.match(r'^\d{2}/\d{4}$', args.month):
+    if not _MONTH_RE.match(args.month):
         parser.error("Month must be in MM/YYYY format (e.g., 09/2025)")
     
     # Validate sheet URL format
-    if not args.sheet_url.startswith('https://docs.google.com/spreadsheets/d/'):
+    if not _SHEET_URL_RE.match(args.sheet_url):
         parser.error("Sheet URL must be a valid Google Sheets URL")
     
     # Validate credentials file exists
@@ -79,52 +114,77 @@ def parse_arguments():
     return args
 
 
+@lru_cache(maxsize=None)
 def get_credentials(credentials_file):
-    """Get and refresh OAuth2 credentials for Google APIs."""
+    """
+    Get and refresh OAuth2 credentials for Google APIs.
+    
+    Credentials are cached per credentials file, so reports for several channels
+    in one process share a single token load and refresh.
+    """
     creds = None
     
     # Load token from file if it exists
-    if os.path.exists(TOKEN_FILE):
+    try:
+        creds = Credentials.from_authorized_user_info(
+            orjson.loads(TOKEN_PATH.read_bytes()), SCOPES)
+    except FileNotFoundError:
+        pass
+    except (ValueError, orjson.JSONDecodeError) as e:
+        logger.error(f"Error loading token file: {e}")
+        TOKEN_PATH.unlink(missing_ok=True)
+    
+    token_updated = False
+    
+    # Refresh expired credentials; if the refresh token has been revoked, fall
+    # through to a new authorization flow instead of retrying
+    if creds and not creds.valid and creds.expired and creds.refresh_token:
         try:
-            creds = Credentials.from_authorized_user_info(
-                json.loads(open(TOKEN_FILE).read()), SCOPES)
-        except (ValueError, json.JSONDecodeError) as e:
-            logger.error(f"Error loading token file: {e}")
-            os.remove(TOKEN_FILE)
+            creds.refresh(Request())
+            token_updated = True
+        except RefreshError as e:
+            logger.error(f"Error refreshing credentials: {e}")
+            TOKEN_PATH.unlink(missing_ok=True)
+            creds = None
     
-    # If credentials don't exist or are invalid, refresh or create new ones
+    # If credentials still don't exist or are invalid, create new ones
     if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            try:
-                creds.refresh(Request())
-            except RefreshError as e:
-                logger.error(f"Error refreshing credentials: {e}")
-                os.remove(TOKEN_FILE)
-                return get_credentials(credentials_file)
-        else:
-            if not os.path.exists(credentials_file):
-                logger.error(f"Credentials file '{credentials_file}' not found.")
-                logger.info("Please download OAuth client ID credentials from Google Cloud Console")
-                sys.exit(1)
-                
-            flow = InstalledAppFlow.from_client_secrets_file(credentials_file, SCOPES)
-            creds = flow.run_local_server(port=0)
+        if not os.path.exists(credentials_file):
+            logger.error(f"Credentials file '{credentials_file}' not found.")
+            logger.info("Please download OAuth client ID credentials from Google Cloud Console")
+            sys.exit(1)
+            
+        # Only needed when minting a new token, so imported lazily
+        from google_auth_oauthlib.flow import InstalledAppFlow
         
-        # Save the credentials for the next run
-        with open(TOKEN_FILE, 'w') as token:
-            token.write(creds.to_json())
+        flow = InstalledAppFlow.from_client_secrets_file(credentials_file, SCOPES)
+        creds = flow.run_local_server(port=0)
+        token_updated = True
+    
+    if token_updated:
+        # Save the credentials for the next run, replacing the token file atomically
+        tmp_token_path = TOKEN_PATH.with_name(f"{TOKEN_PATH.name}.tmp")
+        tmp_token_path.write_bytes(creds.to_json().encode())
+        os.replace(tmp_token_path, TOKEN_PATH)
     
     return creds
 
 
 def extract_sheet_id(sheet_url):
     """Extract the Google Sheet ID from the URL."""
-    match = re.search(r'/d/([a-zA-Z0-9-_]+)', sheet_url)
+    match = _SHEET_URL_RE.match(sheet_url)
     if not match:
         raise ValueError("Invalid Google Sheet URL")
     return match.group(1)
 
 
+def a1_range(sheet_name, cell_range):
+    """Build an A1-notation range with the sheet name quoted (e.g. 'May 2025'!A1:A6)."""
+    escaped_name = sheet_name.replace("'", "''")
+    return f"'{escaped_name}'!{cell_range}"
+
+
+@lru_cache(maxsize=64)
 def get_date_range(month_str):
     """
     Parse the month string and return start date, end date, and month name.
@@ -135,67 +195,215 @@ def get_date_range(month_str):
             raise ValueError("Invalid month or year")
         
         last_day = calendar.monthrange(year, month)[1]
-        start_date = f"{year}-{month:02d}-01"
-        end_date = f"{year}-{month:02d}-{last_day}"
-        month_name = calendar.month_name[month] + " " + str(year)
         
-        return start_date, end_date, month_name
+        return (
+            date(year, month, 1).isoformat(),
+            date(year, month, last_day).isoformat(),
+            f"{_MONTH_NAMES[month]} {year}"
+        )
     except ValueError as e:
         logger.error(f"Error parsing month: {e}")
         raise
 
 
+def _log_api_errors(action, default=None, level=logging.ERROR):
+    """
+    Decorator that logs an HttpError raised by a Google API call and returns a default value.
+    
+    Transient 429/5xx responses are already retried by _execute, so errors reaching
+    here are final.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except HttpError as e:
+                logger.log(level, f"Error {action}: {e}")
+                return default
+        return wrapper
+    return decorator
+
+
+def _is_duplicate_sheet_error(error):
+    """Check whether an HttpError is Sheets rejecting an addSheet whose title is already taken."""
+    if error.resp.status != 400:
+        return False
+    
+    try:
+        message = orjson.loads(error.content)['error']['message']
+    except (ValueError, KeyError, TypeError):
+        return False
+    
+    return 'A sheet with the name' in message and 'already exists' in message
+
+
+class RateLimiter:
+    """Sliding-window rate limiter that allows bursts of up to max_calls per period."""
+    
+    def __init__(self, max_calls, period=60.0):
+        """Initialize the limiter with a call budget per period (in seconds)."""
+        self.max_calls = max_calls
+        self.period = period
+        self._calls = deque()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a call is permitted under the limit, then record it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
+                
+                wait = self.period - (now - self._calls[0])
+            
+            logger.debug(f"Rate limit reached, waiting {wait:.1f}s")
+            time.sleep(wait)
+
+
+def _is_retryable_error(error):
+    """Check whether an HttpError is a rate-limit or transient server error worth retrying."""
+    if error.resp.status in RETRYABLE_STATUSES:
+        return True
+    
+    # The YouTube Data API reports per-minute rate limiting as a 403
+    if error.resp.status == 403:
+        try:
+            reason = orjson.loads(error.content)['error']['errors'][0]['reason']
+        except (ValueError, KeyError, IndexError, TypeError):
+            return False
+        return reason in RATE_LIMIT_REASONS
+    
+    return False
+
+
+def _execute(request, limiter):
+    """
+    Execute a Google API request under a rate limiter, retrying transient failures.
+    
+    Successful calls never wait beyond the rate limiter. Rate-limited and 5xx responses
+    (and dropped connections) are retried up to API_NUM_RETRIES times, waiting for the
+    server's Retry-After when it sends one and for capped exponential backoff otherwise.
+    """
+    for attempt in range(API_NUM_RETRIES + 1):
+        limiter.acquire()
+        try:
+            return request.execute()
+        except HttpError as e:
+            if attempt == API_NUM_RETRIES or not _is_retryable_error(e):
+                raise
+            
+            try:
+                retry_after = float(e.resp['retry-after'])
+            except (KeyError, ValueError):
+                retry_after = math.nan
+            
+            # Fall back to backoff when Retry-After is missing or not a finite number
+            if math.isfinite(retry_after):
+                delay = min(max(0.0, retry_after), MAX_RETRY_DELAY)
+            else:
+                delay = min(2 ** attempt, MAX_RETRY_DELAY) + random.random()
+            
+            logger.warning(f"API returned HTTP {e.resp.status}, retrying in {delay:.1f}s")
+        except (ConnectionError, socket.timeout) as e:
+            if attempt == API_NUM_RETRIES:
+                raise
+            
+            delay = min(2 ** attempt, MAX_RETRY_DELAY) + random.random()
+            logger.warning(f"Connection error ({e}), retrying in {delay:.1f}s")
+        
+        time.sleep(delay)
+
+
 class YouTubeAnalyticsReport:
     """Class to handle YouTube Analytics reporting."""
     
+    __slots__ = (
+        'channel_id', 'start_date', 'end_date', 'sheet_id',
+        'credentials', 'youtube', 'youtube_analytics', 'sheets', 'content_owner_id',
+        '_generated_at', '_sheets_meta', '_pending_writes', '_yt_limiter', '_sheets_limiter'
+    )
+    
     def __init__(self, channel_id, start_date, end_date, sheet_id, credentials_file):
         """Initialize the report generator with the required parameters."""
         self.channel_id = channel_id
         self.start_date = start_date
         self.end_date = end_date
         self.sheet_id = sheet_id
+        self._generated_at = datetime.now().isoformat(sep=' ', timespec='seconds')
+        self._sheets_meta = None
+        self._pending_writes = {}
+        self._yt_limiter = RateLimiter(YOUTUBE_REQUESTS_PER_MINUTE)
+        self._sheets_limiter = RateLimiter(SHEETS_REQUESTS_PER_MINUTE)
         
-        # Initialize API services
+        # Initialize API services concurrently, chaining the content owner lookup
+        # (needed for revenue data) and the spreadsheet metadata fetch off their
+        # services as soon as they're ready, so the two lookups overlap
         self.credentials = get_credentials(credentials_file)
-        self.youtube = build('youtube', 'v3', credentials=self.credentials)
-        self.youtube_analytics = build('youtubeAnalytics', 'v2', credentials=self.credentials)
-        self.sheets = build('sheets', 'v4', credentials=self.credentials)
-        
-        # Get channel content owner ID (needed for revenue data)
-        self.content_owner_id = self._get_content_owner_id()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            youtube_future = executor.submit(self._build_service, 'youtube', 'v3')
+            analytics_future = executor.submit(self._build_service, 'youtubeAnalytics', 'v2')
+            sheets_future = executor.submit(self._build_service, 'sheets', 'v4')
+            
+            self.youtube = youtube_future.result()
+            content_owner_future = executor.submit(self._get_content_owner_id)
+            
+            self.sheets = sheets_future.result()
+            sheets_meta_future = executor.submit(self._prefetch_sheets_meta)
+            
+            self.youtube_analytics = analytics_future.result()
+            self.content_owner_id = content_owner_future.result()
+            sheets_meta_future.result()
         
         logger.info(f"Initialized report for channel {channel_id} from {start_date} to {end_date}")
     
+    def _build_service(self, service_name, version):
+        """
+        Build an API service from the discovery documents bundled with googleapiclient.
+        
+        Each service gets its own HTTP transport since httplib2 isn't thread-safe;
+        sharing one wouldn't save TLS handshakes anyway, as every API is served from
+        its own host. All transports wrap the same Credentials, so a token refresh
+        is shared between them.
+        """
+        http = AuthorizedHttp(self.credentials, http=build_http())
+        return build(service_name, version, http=http, static_discovery=True)
+    
+    @_log_api_errors("getting content owner ID", level=logging.WARNING)
     def _get_content_owner_id(self):
         """Get the content owner ID for the channel if available."""
-        try:
-            response = self.youtube.channels().list(
-                part='contentOwnerDetails',
-                id=self.channel_id
-            ).execute()
-            
-            time.sleep(API_QUOTA_DELAY)  # Respect API quota
-            
-            if 'items' in response and response['items']:
-                content_owner_details = response['items'][0].get('contentOwnerDetails', {})
-                return content_owner_details.get('contentOwner')
-            
-            logger.warning("No content owner found for this channel. Revenue metrics may be unavailable.")
-            return None
-        except HttpError as e:
-            logger.warning(f"Error getting content owner ID: {e}")
-            return None
+        response = _execute(self.youtube.channels().list(
+            part='contentOwnerDetails',
+            id=self.channel_id,
+            fields='items/contentOwnerDetails/contentOwner'
+        ), self._yt_limiter)
+        
+        if 'items' in response and response['items']:
+            content_owner_details = response['items'][0].get('contentOwnerDetails', {})
+            return content_owner_details.get('contentOwner')
+        
+        logger.warning("No content owner found for this channel. Revenue metrics may be unavailable.")
+        return None
     
     def generate_monthly_report(self, month_name):
         """Generate the monthly report and write it to Google Sheets."""
         try:
-            # Check if sheet exists, otherwise create it
-            sheet_exists = self._check_sheet_exists(month_name)
-            if not sheet_exists:
-                self._create_sheet(month_name)
+            # A missing sheet is created and populated in a single batchUpdate;
+            # an existing one only needs its values refreshed
+            if not self._check_sheet_exists(month_name):
+                if not self._create_sheet(month_name, self._basic_info_rows()):
+                    return False
+            else:
+                self._write_basic_info(month_name)
             
-            # Add basic info to the sheet
-            self._write_basic_info(month_name)
+            # Send every queued value write in one request
+            if not self._flush_writes():
+                return False
             
             logger.info(f"Monthly report for {month_name} generated successfully")
             return True
@@ -203,72 +411,145 @@ class YouTubeAnalyticsReport:
             logger.error(f"Error generating monthly report: {e}")
             return False
     
+    def _get_sheets_meta(self):
+        """
+        Return a mapping of sheet title to sheet ID for the spreadsheet.
+        
+        The metadata is fetched once and cached for the lifetime of the report; sheets
+        added by _create_sheet are recorded in the cache rather than refetched.
+        """
+        if self._sheets_meta is None:
+            response = _execute(self.sheets.spreadsheets().get(
+                spreadsheetId=self.sheet_id,
+                fields='sheets.properties(sheetId,title)'
+            ), self._sheets_limiter)
+            # sheetId is omitted from the response when it's 0 (the default first sheet)
+            self._sheets_meta = {
+                sheet['properties']['title']: sheet['properties'].get('sheetId', 0)
+                for sheet in response.get('sheets', [])
+            }
+        
+        return self._sheets_meta
+    
+    def _prefetch_sheets_meta(self):
+        """Warm the spreadsheet metadata cache; a failure here is retried on first use."""
+        try:
+            self._get_sheets_meta()
+        except Exception as e:
+            # Any failure (HTTP, connection, DNS) leaves the cache empty for a later fetch
+            logger.warning(f"Error prefetching spreadsheet metadata: {e}")
+    
+    @_log_api_errors("checking sheet existence", default=False)
     def _check_sheet_exists(self, sheet_name):
         """Check if a sheet with the given name already exists."""
-        try:
-            response = self.sheets.spreadsheets().get(spreadsheetId=self.sheet_id).execute()
-            
-            for sheet in response.get('sheets', []):
-                if sheet['properties']['title'] == sheet_name:
-                    return True
-            
-            return False
-        except HttpError as e:
-            logger.error(f"Error checking sheet existence: {e}")
-            return False
+        return sheet_name in self._get_sheets_meta()
     
-    def _create_sheet(self, sheet_name):
-        """Create a new sheet."""
-        try:
-            request = {
-                'requests': [{
-                    'addSheet': {
-                        'properties': {
-                            'title': sheet_name
-                        }
-                    }
-                }]
+    @_log_api_errors("creating sheet", default=False)
+    def _create_sheet(self, sheet_name, rows=None):
+        """Create a new sheet, optionally populating it with rows of values in the same request."""
+        # Assign the sheet ID ourselves so the cell update can target it in the same batch
+        new_sheet_id = max(self._get_sheets_meta().values(), default=0) + 1
+        
+        requests = [{
+            'addSheet': {
+                'properties': {
+                    'sheetId': new_sheet_id,
+                    'title': sheet_name
+                }
             }
-            
-            self.sheets.spreadsheets().batchUpdate(
+        }]
+        
+        if rows:
+            requests.append({
+                'updateCells': {
+                    'rows': [
+                        {'values': [{'userEnteredValue': {'stringValue': value}} for value in row]}
+                        for row in rows
+                    ],
+                    'fields': 'userEnteredValue',
+                    'start': {
+                        'sheetId': new_sheet_id,
+                        'rowIndex': 0,
+                        'columnIndex': 0
+                    }
+                }
+            })
+        
+        try:
+            _execute(self.sheets.spreadsheets().batchUpdate(
                 spreadsheetId=self.sheet_id,
-                body=request
-            ).execute()
+                body={'requests': requests},
+                fields='spreadsheetId'
+            ), self._sheets_limiter)
+        except HttpError as e:
+            if not _is_duplicate_sheet_error(e):
+                raise
             
-            logger.info(f"Created new sheet: {sheet_name}")
+            # The sheet was added after our metadata was fetched (e.g. by a concurrent
+            # run), so drop the stale metadata and write into the existing sheet instead
+            logger.info(f"Sheet already exists: {sheet_name}")
+            self._sheets_meta = None
+            if rows:
+                self._queue_text_rows(sheet_name, rows)
             return True
-        except HttpError as e:
-            logger.error(f"Error creating sheet: {e}")
-            return False
+        
+        self._sheets_meta[sheet_name] = new_sheet_id
+        logger.info(f"Created new sheet: {sheet_name}")
+        return True
+    
+    def _basic_info_rows(self):
+        """Build the header rows written at the top of the report sheet, as a tuple of rows."""
+        return (
+            ("YouTube Analytics Report",),
+            (f"Channel ID: {self.channel_id}",),
+            (f"Reporting Period: {self.start_date} to {self.end_date}",),
+            (f"Generated on: {self._generated_at}",),
+            ("",),  # Empty row
+            ("Report is being populated. This is a test connection.",)
+        )
     
     def _write_basic_info(self, sheet_name):
-        """Write basic information to the sheet."""
-        try:
-            values = [
-                ["YouTube Analytics Report"],
-                [f"Channel ID: {self.channel_id}"],
-                [f"Reporting Period: {self.start_date} to {self.end_date}"],
-                [f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"],
-                [""],  # Empty row
-                ["Report is being populated. This is a test connection."]
-            ]
-            
+        """Queue the basic information rows for writing to the sheet."""
+        self._queue_text_rows(sheet_name, self._basic_info_rows())
+    
+    def _queue_text_rows(self, sheet_name, rows):
+        """Queue single-column rows of plain text for writing from the top of the sheet."""
+        # Plain text, so skip the formula/locale parsing of USER_ENTERED
+        self._queue_write(a1_range(sheet_name, f"A1:A{len(rows)}"), rows, 'RAW')
+    
+    def _queue_write(self, range_name, values, value_input_option='USER_ENTERED'):
+        """
+        Queue a block of values to be written by the next _flush_writes call.
+        
+        Use value_input_option='RAW' for literal text; the default USER_ENTERED parses
+        formulas, numbers and dates as if typed into the sheet.
+        """
+        self._pending_writes.setdefault(value_input_option, []).append({
+            'range': range_name,
+            'values': values,
+            'majorDimension': 'ROWS'
+        })
+    
+    @_log_api_errors("writing to sheet", default=False)
+    def _flush_writes(self):
+        """Write queued value ranges with one values.batchUpdate call per input option."""
+        while self._pending_writes:
+            value_input_option, data = next(iter(self._pending_writes.items()))
             body = {
-                'values': values
+                'valueInputOption': value_input_option,
+                'data': data
             }
             
-            self.sheets.spreadsheets().values().update(
+            _execute(self.sheets.spreadsheets().values().batchUpdate(
                 spreadsheetId=self.sheet_id,
-                range=f"{sheet_name}!A1",
-                valueInputOption='USER_ENTERED',
-                body=body
-            ).execute()
+                body=body,
+                fields='totalUpdatedCells'
+            ), self._sheets_limiter)
             
-            logger.info(f"Basic info written to sheet: {sheet_name}")
-            return True
-        except HttpError as e:
-            logger.error(f"Error writing to sheet: {e}")
-            return False
+            logger.info(f"Wrote {len(data)} range(s) to the spreadsheet ({value_input_option})")
+            del self._pending_writes[value_input_option]
+        
+        return True
 
 
 def main():
@@ -276,9 +557,8 @@ def main():
     # Parse command line arguments
     args = parse_arguments()
     
-    # Set log level
-    if args.debug:
-        logger.setLevel(logging.DEBUG)
+    # Set up logging
+    setup_logging(args.debug)
     
     # Load environment variables from .env file if it exists
     load_dotenv()